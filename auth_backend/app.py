@@ -2,8 +2,20 @@ from flask import Flask, request, jsonify, make_response, send_file
 from flask_cors import CORS
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from database import db, User, ChatSession, ChatMessage, Document, AdminCredentials
+from database import (
+    db, User, ChatSession, ChatMessage, Document, AdminCredentials, PurgeJob, RetentionPolicy,
+    add_missing_columns,
+)
 from email_validator import validate_email, EmailNotValidError
+from usage import (
+    record_usage_event, flush_usage_events, compact_usage_events, ensure_usage_flusher,
+    usage_timeseries, top_users, bucket_step, GRANULARITIES,
+)
+from session_summary import apply_new_messages, repair_summaries, find_inconsistent_sessions
+import doc_search
+import purge
+from datetime import datetime, timedelta, timezone
+import atexit
 import io
 
 app = Flask(__name__)
@@ -50,6 +62,7 @@ login_manager.init_app(app)
 login_manager.login_view = 'login'
 
 ADMIN_TOKEN = 'admin-token-here'
+MAX_USAGE_BUCKETS = 24 * 31
 
 
 @login_manager.user_loader
@@ -92,6 +105,11 @@ def require_not_blocked():
 
 with app.app_context():
     db.create_all()
+    # Backfill session summaries the first time their columns are added
+    if add_missing_columns(ChatSession):
+        repair_summaries()
+    add_missing_columns(ChatMessage)
+    add_missing_columns(PurgeJob)
     # Seed default admin if none exists
     if not AdminCredentials.query.first():
         default_admin = AdminCredentials(username='admin')
@@ -100,6 +118,61 @@ with app.app_context():
         db.session.commit()
 
 
+def _flush_usage_on_exit():
+    with app.app_context():
+        flush_usage_events()
+
+atexit.register(_flush_usage_on_exit)
+
+
+@app.before_request
+def _start_background_workers():
+    purge.ensure_worker(app)
+    ensure_usage_flusher(app)
+    doc_search.ensure_indexer(app)
+
+
+@app.cli.command('compact-usage')
+def compact_usage_command():
+    """Prune raw usage events older than USAGE_EVENT_RETENTION_DAYS."""
+    flush_usage_events()
+    print(f"Deleted {compact_usage_events()} usage events")
+
+
+@app.cli.command('repair-session-summaries')
+def repair_session_summaries_command():
+    """Rebuild ChatSession summary fields from chat_message."""
+    print(f"Repaired {repair_summaries()} chat sessions")
+
+
+@app.cli.command('check-session-summaries')
+def check_session_summaries_command():
+    """Report chat sessions whose summary fields have drifted."""
+    problems = find_inconsistent_sessions()
+    for p in problems:
+        diffs = ', '.join(f"{f}: {p['stored'][f]!r} -> {p['actual'][f]!r}" for f in p['fields'])
+        print(f"session {p['session_id']}: {diffs}")
+    print(f"{len(problems)} inconsistent chat sessions")
+
+
+@app.cli.command('index-documents')
+def index_documents_command():
+    """Build or repair every user's document search index in the foreground."""
+    user_ids = [row.user_id for row in db.session.query(Document.user_id).distinct()]
+    for user_id in user_ids:
+        doc_ids = [row.id for row in db.session.query(Document.id).filter_by(user_id=user_id)]
+        doc_search.sync_user_index(user_id, {i: (lambda i=i: db.session.get(Document, i)) for i in doc_ids})
+        db.session.expunge_all()
+    print(f"Indexed documents for {len(user_ids)} users")
+
+
+@app.cli.command('run-purges')
+def run_purges_command():
+    """Queue due retention policies and run all pending purge jobs in the foreground."""
+    purge.apply_retention_policies()
+    print(f"Ran {purge.run_pending_jobs()} purge jobs")
+
+
 # ---------------------------------------------------------------------------
 # Public routes
 # ---------------------------------------------------------------------------
@@ -320,6 +393,116 @@ def admin_get_stats():
     })
 
 
+def _parse_utc(value):
+    """Parse an ISO timestamp into naive UTC, the form every DateTime column uses."""
+    try:
+        ts = datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith('Z') else value)
+    except ValueError:
+        raise ValueError(f"invalid timestamp: {value}")
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+
+def _parse_usage_window(default_periods):
+    """Read granularity/since/until/periods query params for the usage routes."""
+    granularity = request.args.get('granularity', 'hour')
+    if granularity not in GRANULARITIES:
+        raise ValueError("granularity must be 'hour' or 'day'")
+    until = request.args.get('until')
+    until = _parse_utc(until) if until else datetime.utcnow()
+    since = request.args.get('since')
+    if since:
+        since = _parse_utc(since)
+    else:
+        periods = max(1, min(int(request.args.get('periods', default_periods)), MAX_USAGE_BUCKETS))
+        since = until - (periods - 1) * bucket_step(granularity)
+    if since > until:
+        raise ValueError("since must not be after until")
+    if (until - since) // bucket_step(granularity) >= MAX_USAGE_BUCKETS:
+        raise ValueError(f"At most {MAX_USAGE_BUCKETS} buckets per query")
+    return granularity, since, until
+
+
+@app.route('/admin/usage/timeseries', methods=['GET'])
+def admin_usage_timeseries():
+    if not check_admin_token():
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    try:
+        granularity, since, until = _parse_usage_window(24)
+        user_id = int(request.args.get('user_id', 0))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    flush_usage_events()
+    points = usage_timeseries(granularity, since, until, user_id=user_id)
+    return jsonify({
+        "status": "success",
+        "granularity": granularity,
+        "user_id": user_id,
+        "points": points,
+    })
+
+
+@app.route('/admin/usage/top', methods=['GET'])
+def admin_usage_top():
+    if not check_admin_token():
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    try:
+        granularity, since, until = _parse_usage_window(1)
+        limit = max(1, min(int(request.args.get('limit', 10)), 100))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    metric = request.args.get('metric', 'tokens')
+    if metric not in ('tokens', 'calls'):
+        return jsonify({"status": "error", "message": "metric must be 'tokens' or 'calls'"}), 400
+    flush_usage_events()
+    ranked = top_users(granularity, since, until, metric=metric, limit=limit)
+    emails = dict(db.session.query(User.id, User.email).filter(User.id.in_([r["user_id"] for r in ranked])))
+    for r in ranked:
+        r["email"] = emails.get(r["user_id"])
+    return jsonify({
+        "status": "success",
+        "granularity": granularity,
+        "since": since.isoformat(),
+        "until": until.isoformat(),
+        "metric": metric,
+        "users": ranked,
+    })
+
+
+@app.route('/admin/session-summaries/check', methods=['GET'])
+def admin_check_session_summaries():
+    if not check_admin_token():
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    problems = find_inconsistent_sessions()
+    return jsonify({"status": "success", "inconsistent": len(problems), "sessions": problems[:100]})
+
+
+@app.route('/admin/session-summaries/repair', methods=['POST'])
+def admin_repair_session_summaries():
+    if not check_admin_token():
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    return jsonify({"status": "success", "repaired": repair_summaries()})
+
+
+@app.route('/admin/usage/compact', methods=['POST'])
+def admin_usage_compact():
+    if not check_admin_token():
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    data = request.get_json(silent=True) or {}
+    retention_days = data.get('retention_days')
+    if retention_days is not None:
+        try:
+            retention_days = int(retention_days)
+        except (TypeError, ValueError):
+            return jsonify({"status": "error", "message": "retention_days must be an integer"}), 400
+        if retention_days < 0:
+            return jsonify({"status": "error", "message": "retention_days must not be negative"}), 400
+    flush_usage_events()
+    deleted = compact_usage_events(retention_days)
+    return jsonify({"status": "success", "deleted_events": deleted})
+
+
 # ---------------------------------------------------------------------------
 # User utility routes
 # ---------------------------------------------------------------------------
@@ -334,17 +517,19 @@ def get_user_profile():
     if not user:
         return jsonify({"status": "error", "message": "User not found"}), 404
 
-    # Get chat sessions with messages
+    # Get chat sessions with messages; counts come from the session summary and
+    # all messages are loaded in one query rather than one per session
+    sessions = ChatSession.query.filter_by(user_id=user.id).order_by(ChatSession.created_at.desc()).all()
+    msgs_by_session = {s.id: [] for s in sessions}
+    if sessions:
+        for m in (ChatMessage.query.filter(ChatMessage.session_id.in_(msgs_by_session))
+                  .order_by(ChatMessage.created_at, ChatMessage.id)):
+            msgs_by_session[m.session_id].append(m)
     chat_sessions = []
-    for s in ChatSession.query.filter_by(user_id=user.id).order_by(ChatSession.created_at.desc()).all():
-        msgs = ChatMessage.query.filter_by(session_id=s.id).order_by(ChatMessage.created_at).all()
+    for s in sessions:
         chat_sessions.append({
-            "id": s.id,
-            "title": s.title,
-            "message_count": len(msgs),
-            "created_at": s.created_at.isoformat() if s.created_at else None,
-            "last_message_at": msgs[-1].created_at.isoformat() if msgs and msgs[-1].created_at else None,
-            "messages": [{"role": m.role, "content": m.content, "created_at": m.created_at.isoformat() if m.created_at else None} for m in msgs],
+            **_session_summary_json(s),
+            "messages": [{"role": m.role, "content": m.content, "created_at": m.created_at.isoformat() if m.created_at else None} for m in msgs_by_session[s.id]],
         })
 
     # Get documents
@@ -403,6 +588,7 @@ def track_usage(user_id):
     user.ai_usage_count += 1
     user.ai_tokens_used += int(tokens)
     db.session.commit()
+    record_usage_event(user.id, tokens)
     return jsonify({
         "status": "success",
         "ai_usage_count": user.ai_usage_count,
@@ -428,6 +614,7 @@ def track_usage_by_email():
     user.ai_usage_count += 1
     user.ai_tokens_used += tokens
     db.session.commit()
+    record_usage_event(user.id, tokens)
     return jsonify({
         "status": "success",
         "ai_usage_count": user.ai_usage_count,
@@ -439,6 +626,38 @@ def track_usage_by_email():
 # Chat routes
 # ---------------------------------------------------------------------------
 
+def _session_summary_json(s):
+    return {
+        "id": s.id,
+        "title": s.title,
+        "message_count": s.message_count,
+        "created_at": s.created_at.isoformat() if s.created_at else None,
+        "last_message_at": s.last_message_at.isoformat() if s.last_message_at else None,
+        "last_message_preview": s.last_message_preview,
+        "content_bytes": s.content_bytes,
+    }
+
+
+@app.route('/chat/sessions', methods=['GET'])
+def list_chat_sessions():
+    """Session list ordered by last activity, served from the summary fields."""
+    email = request.args.get('email') or request.headers.get('X-User-Email')
+    if not email:
+        return jsonify({"status": "error", "message": "email required"}), 400
+    user = User.query.filter_by(email=email).first()
+    if not user:
+        return jsonify({"status": "error", "message": "User not found"}), 404
+    limit = max(1, min(request.args.get('limit', 50, type=int), 200))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    sessions = (ChatSession.query.filter_by(user_id=user.id)
+                .order_by(ChatSession.last_activity.desc(), ChatSession.id.desc())
+                .offset(offset).limit(limit).all())
+    return jsonify({
+        "status": "success",
+        "sessions": [_session_summary_json(s) for s in sessions],
+    })
+
+
 @app.route('/chat/sessions', methods=['POST'])
 def create_chat_session():
     blocked = require_not_blocked()
@@ -476,8 +695,9 @@ def add_chat_message(session_id):
         return jsonify({"status": "error", "message": "role and content are required"}), 400
     if role not in ('user', 'assistant'):
         return jsonify({"status": "error", "message": "role must be 'user' or 'assistant'"}), 400
-    message = ChatMessage(session_id=session_id, role=role, content=content)
+    message = ChatMessage(session_id=session_id, role=role, content=content, created_at=datetime.utcnow())
     db.session.add(message)
+    apply_new_messages(session_id, [message])
     db.session.commit()
     return jsonify({
         "status": "success",
@@ -517,6 +737,7 @@ def upload_document():
     )
     db.session.add(doc)
     db.session.commit()
+    doc_search.queue_add(user.id, doc.id)
     return jsonify({
         "status": "success",
         "document_id": doc.id,
@@ -526,6 +747,51 @@ def upload_document():
     })
 
 
+@app.route('/documents/<int:doc_id>', methods=['DELETE'])
+def delete_document(doc_id):
+    blocked = require_not_blocked()
+    if blocked: return blocked
+    user = get_user_from_request()
+    if not user:
+        return jsonify({"status": "error", "message": "User not found"}), 404
+    doc = Document.query.filter_by(id=doc_id, user_id=user.id).first()
+    if not doc:
+        return jsonify({"status": "error", "message": "Document not found"}), 404
+    db.session.delete(doc)
+    db.session.commit()
+    # Removal can trigger a compaction, so it runs on the indexer thread; the
+    # delete has already succeeded and must not turn into a 500 here
+    doc_search.queue_remove(user.id, doc_id)
+    return jsonify({"status": "success", "document_id": doc_id})
+
+
+@app.route('/documents/search', methods=['GET'])
+def search_documents():
+    """Rank chunks from all of the requesting user's documents against ?q=."""
+    blocked = require_not_blocked()
+    if blocked: return blocked
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({"status": "error", "message": "q is required"}), 400
+    user = get_user_from_request()
+    if not user:
+        return jsonify({"status": "error", "message": "User not found"}), 404
+    k = max(1, min(request.args.get('k', 8, type=int), 50))
+
+    # Only ids are compared here; unindexed documents are extracted in the background
+    doc_ids = [row.id for row in db.session.query(Document.id).filter_by(user_id=user.id)]
+    pending = doc_search.queue_sync(user.id, doc_ids)
+    results = doc_search.index_for_user(user.id).search(query, k)
+
+    # Drop hits from documents deleted since their rows were last tombstoned
+    filenames = dict(db.session.query(Document.id, Document.filename)
+                     .filter(Document.id.in_({r["document_id"] for r in results})))
+    results = [r for r in results if r["document_id"] in filenames]
+    for r in results:
+        r["filename"] = filenames[r["document_id"]]
+    return jsonify({"status": "success", "query": query, "results": results, "pending_documents": pending})
+
+
 import csv
 import io as _io
 
@@ -551,14 +817,145 @@ def admin_change_password():
 def admin_clear_chats():
     if not check_admin_token():
         return jsonify({"status": "error", "message": "Unauthorized"}), 401
-    deleted_messages = ChatMessage.query.delete()
-    deleted_sessions = ChatSession.query.delete()
+    # Deleting everything in one transaction holds the write lock for minutes on
+    # a large database, so this only queues a batched background purge.
+    job = purge.enqueue_purge('chats')
+    return jsonify({"status": "success", "job_id": job.id, "job": purge.job_json(job)}), 202
+
+
+@app.route('/admin/purge', methods=['POST'])
+def admin_purge():
+    if not check_admin_token():
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    data = request.get_json(silent=True) or {}
+    target = data.get('target')
+    if target not in purge.TARGETS:
+        return jsonify({"status": "error", "message": "target must be 'chats' or 'documents'"}), 400
+    older_than = None
+    if data.get('older_than_days') is not None:
+        try:
+            older_than_days = int(data['older_than_days'])
+        except (TypeError, ValueError):
+            return jsonify({"status": "error", "message": "older_than_days must be an integer"}), 400
+        if older_than_days < 0:
+            return jsonify({"status": "error", "message": "older_than_days must not be negative"}), 400
+        older_than = datetime.utcnow() - timedelta(days=older_than_days)
+    user_id = data.get('user_id')
+    if user_id is not None:
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return jsonify({"status": "error", "message": "user_id must be an integer"}), 400
+        if not User.query.get(user_id):
+            return jsonify({"status": "error", "message": "User not found"}), 404
+    job = purge.enqueue_purge(target, user_id=user_id, older_than=older_than)
+    return jsonify({"status": "success", "job_id": job.id, "job": purge.job_json(job)}), 202
+
+
+@app.route('/admin/jobs', methods=['GET'])
+def admin_list_jobs():
+    if not check_admin_token():
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    jobs = PurgeJob.query.order_by(PurgeJob.id.desc()).limit(50).all()
+    return jsonify({"status": "success", "jobs": [purge.job_json(j) for j in jobs]})
+
+
+@app.route('/admin/jobs/<int:job_id>', methods=['GET'])
+def admin_get_job(job_id):
+    if not check_admin_token():
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    job = PurgeJob.query.get(job_id)
+    if not job:
+        return jsonify({"status": "error", "message": "Job not found"}), 404
+    return jsonify({"status": "success", "job": purge.job_json(job)})
+
+
+@app.route('/admin/jobs/<int:job_id>/resume', methods=['POST'])
+def admin_resume_job(job_id):
+    if not check_admin_token():
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    job = PurgeJob.query.get(job_id)
+    if not job:
+        return jsonify({"status": "error", "message": "Job not found"}), 404
+    if job.status != 'failed':
+        return jsonify({"status": "error", "message": "Only failed jobs can be resumed"}), 400
+    job.status = 'pending'
+    job.error = None
     db.session.commit()
-    return jsonify({
-        "status": "success",
-        "deleted_sessions": deleted_sessions,
-        "deleted_messages": deleted_messages,
-    })
+    purge.ensure_worker(app)
+    return jsonify({"status": "success", "job": purge.job_json(job)})
+
+
+def _retention_policy_json(p):
+    return {
+        "id": p.id,
+        "target": p.target,
+        "user_id": p.user_id,
+        "max_age_days": p.max_age_days,
+        "enabled": p.enabled,
+        "created_at": p.created_at.isoformat() if p.created_at else None,
+        "last_run_at": p.last_run_at.isoformat() if p.last_run_at else None,
+    }
+
+
+@app.route('/admin/retention-policies', methods=['GET'])
+def admin_list_retention_policies():
+    if not check_admin_token():
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    policies = RetentionPolicy.query.order_by(RetentionPolicy.id).all()
+    return jsonify({"status": "success", "policies": [_retention_policy_json(p) for p in policies]})
+
+
+@app.route('/admin/retention-policies', methods=['POST'])
+def admin_create_retention_policy():
+    if not check_admin_token():
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    data = request.get_json(silent=True) or {}
+    target = data.get('target')
+    if target not in purge.TARGETS:
+        return jsonify({"status": "error", "message": "target must be 'chats' or 'documents'"}), 400
+    try:
+        max_age_days = int(data.get('max_age_days'))
+    except (TypeError, ValueError):
+        return jsonify({"status": "error", "message": "max_age_days must be an integer"}), 400
+    if max_age_days < 0:
+        return jsonify({"status": "error", "message": "max_age_days must not be negative"}), 400
+    user_id = data.get('user_id')
+    if user_id is not None:
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return jsonify({"status": "error", "message": "user_id must be an integer"}), 400
+        if not User.query.get(user_id):
+            return jsonify({"status": "error", "message": "User not found"}), 404
+    policy = RetentionPolicy(target=target, user_id=user_id, max_age_days=max_age_days,
+                             enabled=bool(data.get('enabled', True)))
+    db.session.add(policy)
+    db.session.commit()
+    return jsonify({"status": "success", "policy": _retention_policy_json(policy)})
+
+
+@app.route('/admin/retention-policies/<int:policy_id>', methods=['DELETE'])
+def admin_delete_retention_policy(policy_id):
+    if not check_admin_token():
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    policy = RetentionPolicy.query.get(policy_id)
+    if not policy:
+        return jsonify({"status": "error", "message": "Policy not found"}), 404
+    PurgeJob.query.filter_by(policy_id=policy_id).update({PurgeJob.policy_id: None})
+    db.session.delete(policy)
+    db.session.commit()
+    return jsonify({"status": "success", "policy_id": policy_id})
+
+
+@app.route('/admin/retention/run', methods=['POST'])
+def admin_run_retention():
+    """Queue purges for every enabled retention policy now."""
+    if not check_admin_token():
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    jobs = purge.apply_retention_policies(force=True)
+    db.session.commit()
+    return jsonify({"status": "success", "jobs": [purge.job_json(j) for j in jobs]}), 202
 
 
 @app.route('/admin/export/users', methods=['GET'])
@@ -0,0 +1,28 @@
+"""Per-process background threads (purge worker, usage flusher, search indexer)."""
+import os
+import threading
+
+_threads = {}
+_lock = threading.Lock()
+
+
+def start_process_thread(name, target, app):
+    """Run ``target(app)`` on a daemon thread unless this process already has one named ``name``.
+
+    Called per request rather than at import: with preload_app the app is
+    imported in the gunicorn master, and threads do not survive the fork.
+    """
+    pid = os.getpid()
+
+    def running():
+        entry = _threads.get(name)
+        return entry is not None and entry[0] == pid and entry[1].is_alive()
+
+    if running():
+        return
+    with _lock:
+        if running():
+            return
+        thread = threading.Thread(target=target, args=(app,), name=name, daemon=True)
+        _threads[name] = (pid, thread)
+        thread.start()
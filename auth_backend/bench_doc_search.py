@@ -0,0 +1,71 @@
+"""Benchmark doc_search.ChunkIndex at 1k, 10k and 100k chunks.
+
+Builds throwaway indexes from synthetic documents and reports build time,
+on-disk size and query latency. Run with ``python bench_doc_search.py``;
+pass chunk counts as arguments to override the defaults.
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from doc_search import ChunkIndex, CHUNK_SIZE, CHUNK_OVERLAP
+
+VOCAB_SIZE = 50000
+CHUNKS_PER_DOC = 20
+QUERIES = 50
+
+
+def synthetic_document(rng, vocab, n_chunks):
+    # Enough words for exactly n_chunks overlapping chunks
+    n_words = CHUNK_SIZE + (n_chunks - 1) * (CHUNK_SIZE - CHUNK_OVERLAP)
+    # Zipf-like word frequencies, like natural text
+    ranks = np.minimum(rng.zipf(1.3, n_words), len(vocab)) - 1
+    return ' '.join(vocab[r] for r in ranks)
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+def bench(n_chunks, vocab, seed=0):
+    rng = np.random.default_rng(seed)
+    path = tempfile.mkdtemp(prefix='bench_doc_search_')
+    try:
+        index = ChunkIndex(path)
+        start = time.perf_counter()
+        doc_id = 0
+        while index.read_meta()['rows'] < n_chunks:
+            remaining = n_chunks - index.read_meta()['rows']
+            doc_id += 1
+            index.add_document(doc_id, synthetic_document(rng, vocab, min(CHUNKS_PER_DOC, remaining)))
+        build = time.perf_counter() - start
+
+        queries = [' '.join(random.Random(seed + i).sample(vocab[:5000], 4)) for i in range(QUERIES)]
+        index.search(queries[0])  # warm the page cache
+        timings = []
+        for q in queries:
+            t = time.perf_counter()
+            index.search(q, k=8)
+            timings.append(time.perf_counter() - t)
+        timings = np.array(timings) * 1000
+        print(f"{n_chunks:>7} chunks  {doc_id:>5} docs  build {build:7.2f}s  "
+              f"size {directory_size(path) / 2**20:7.1f} MiB  "
+              f"query p50 {np.percentile(timings, 50):7.2f} ms  p95 {np.percentile(timings, 95):7.2f} ms")
+    finally:
+        shutil.rmtree(path)
+
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [1000, 10000, 100000]
+    vocab = [f'word{i}' for i in range(VOCAB_SIZE)]
+    for n in sizes:
+        bench(n, vocab)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,8 @@ from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 from datetime import datetime
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateIndex
 
 db = SQLAlchemy()
 
@@ -35,14 +37,26 @@ class ChatSession(db.Model):
     title = db.Column(db.String(255), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
 
+    # Denormalized summary, maintained by session_summary.apply_new_messages
+    message_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    last_message_at = db.Column(db.DateTime, nullable=True)
+    last_message_preview = db.Column(db.String(200), nullable=True)
+    content_bytes = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+
     messages = db.relationship('ChatMessage', backref='session', lazy=True, cascade='all, delete-orphan')
 
 
+# Sessions are listed by last activity, falling back to creation time for empty
+# ones. An expression index serves that order on both SQLite and Postgres.
+ChatSession.last_activity = db.func.coalesce(ChatSession.last_message_at, ChatSession.created_at)
+db.Index('ix_chat_session_user_last_activity', ChatSession.user_id, ChatSession.last_activity, ChatSession.id)
+
+
 class ChatMessage(db.Model):
     __tablename__ = 'chat_message'
 
     id = db.Column(db.Integer, primary_key=True)
-    session_id = db.Column(db.Integer, db.ForeignKey('chat_session.id'), nullable=False)
+    session_id = db.Column(db.Integer, db.ForeignKey('chat_session.id'), nullable=False, index=True)
     role = db.Column(db.String(20), nullable=False)  # 'user' or 'assistant'
     content = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
@@ -72,3 +86,96 @@ class AdminCredentials(db.Model):
 
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
+
+
+class UsageEvent(db.Model):
+    """Append-only raw AI usage events, pruned after the retention window."""
+    __tablename__ = 'usage_event'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    tokens = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+
+class UsageRollup(db.Model):
+    """Pre-aggregated usage per hour/day bucket. user_id 0 holds the global totals."""
+    __tablename__ = 'usage_rollup'
+    __table_args__ = (
+        db.UniqueConstraint('granularity', 'bucket_start', 'user_id', name='uq_usage_rollup_bucket'),
+        db.Index('ix_usage_rollup_series', 'granularity', 'user_id', 'bucket_start'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    granularity = db.Column(db.String(10), nullable=False)  # 'hour' or 'day'
+    bucket_start = db.Column(db.DateTime, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    calls = db.Column(db.Integer, default=0, nullable=False)
+    tokens = db.Column(db.Integer, default=0, nullable=False)
+
+
+def add_missing_columns(model):
+    """Add columns declared on ``model`` but missing from an existing table.
+
+    ``db.create_all()`` only creates new tables, so columns added to an existing
+    model are applied here with ALTER TABLE. Returns the names of added columns.
+    """
+    table = model.__table__
+    inspector = inspect(db.engine)
+    if not inspector.has_table(table.name):
+        return []
+    existing = {c['name'] for c in inspector.get_columns(table.name)}
+    added = []
+    with db.engine.begin() as conn:
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(db.engine.dialect)}'
+            if column.server_default is not None:
+                ddl += f" DEFAULT {column.server_default.arg}"
+            conn.execute(text(ddl))
+            added.append(column.name)
+    # IF NOT EXISTS rather than reflection: inspector.get_indexes() cannot see
+    # expression indexes, so they would look missing on every start
+    with db.engine.begin() as conn:
+        for index in table.indexes:
+            conn.execute(CreateIndex(index, if_not_exists=True))
+    return added
+
+
+class RetentionPolicy(db.Model):
+    """Delete chats or documents older than max_age_days, for one user or everyone."""
+    __tablename__ = 'retention_policy'
+
+    id = db.Column(db.Integer, primary_key=True)
+    target = db.Column(db.String(20), nullable=False)  # 'chats' or 'documents'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)  # None = all users
+    max_age_days = db.Column(db.Integer, nullable=False)
+    enabled = db.Column(db.Boolean, default=True, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    last_run_at = db.Column(db.DateTime, nullable=True)
+
+
+class PurgeJob(db.Model):
+    """A resumable batched delete. cursor is the last primary key already processed."""
+    __tablename__ = 'purge_job'
+
+    id = db.Column(db.Integer, primary_key=True)
+    target = db.Column(db.String(20), nullable=False)  # 'chats' or 'documents'
+    user_id = db.Column(db.Integer, nullable=True)
+    older_than = db.Column(db.DateTime, nullable=True)
+    policy_id = db.Column(db.Integer, db.ForeignKey('retention_policy.id'), nullable=True)
+    status = db.Column(db.String(20), default='pending', nullable=False, index=True)  # pending/running/done/failed
+    cursor = db.Column(db.Integer, default=0, nullable=False)
+    max_id = db.Column(db.Integer, default=0, nullable=False)
+    # Unfiltered chat purges first walk chat_message by id up to max_message_id
+    message_cursor = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    max_message_id = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    deleted_sessions = db.Column(db.Integer, default=0, nullable=False)
+    deleted_messages = db.Column(db.Integer, default=0, nullable=False)
+    deleted_documents = db.Column(db.Integer, default=0, nullable=False)
+    error = db.Column(db.Text, nullable=True)
+    locked_until = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    finished_at = db.Column(db.DateTime, nullable=True)
@@ -0,0 +1,484 @@
+"""Server-side similarity search across a user's whole document library.
+
+Every document is split into overlapping word chunks (same sizes as the
+frontend RAG engine in groq-api.ts) and each chunk becomes one row of a sparse
+CSR matrix of hashed term weights. Rows are stored "lnc" (log tf, cosine
+normalised, no idf) and queries "ltc" (log tf * idf, normalised), so adding a
+document only appends rows and bumps document frequencies; old rows never need
+rewriting.
+
+Each user's matrix lives in its own directory as raw little-endian arrays that
+are appended to and read back with ``np.memmap``. ``meta.json`` records how many
+rows/values/bytes are valid, so a half-written append is ignored by readers and
+truncated by the next writer. Deleted documents are tombstoned and their rows
+dropped the next time the matrix is compacted into a new generation.
+
+Text extraction and compaction can take seconds, so requests never index
+directly: they queue work for a per-process indexer thread.
+"""
+import fcntl
+import io
+import json
+import os
+import queue
+import re
+import threading
+import zipfile
+import zlib
+from collections import Counter
+from contextlib import contextmanager
+
+import numpy as np
+
+from background import start_process_thread
+
+CHUNK_SIZE = 400      # words per chunk, matches the frontend RAG engine
+CHUNK_OVERLAP = 80
+N_FEATURES = 1 << 18  # hashed vocabulary size
+COMPACT_RATIO = 0.25  # compact once this share of rows belongs to deleted documents
+
+
+def _default_index_dir():
+    # Mirror get_db_uri: keep the index on the persistent volume when there is one
+    if os.path.isdir('/data'):
+        return '/data/search_index'
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'search_index')
+
+
+SEARCH_INDEX_DIR = os.environ.get('SEARCH_INDEX_DIR') or _default_index_dir()
+
+_TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+# (file suffix, dtype) of every append-only array. Row arrays hold one entry per
+# chunk; indptr holds each row's end offset into indices/data, text_end each
+# row's end offset into texts.
+_ARRAYS = {
+    'indptr': ('indptr.i64', np.int64),
+    'indices': ('indices.i32', np.int32),
+    'data': ('data.f32', np.float32),
+    'doc_ids': ('doc_ids.i32', np.int32),
+    'word_start': ('word_start.i32', np.int32),
+    'text_end': ('text_end.i64', np.int64),
+}
+_ROW_ARRAYS = ('indptr', 'doc_ids', 'word_start', 'text_end')
+
+
+# ---------------------------------------------------------------------------
+# Text processing
+# ---------------------------------------------------------------------------
+
+def extract_text(filename, file_type, file_data):
+    """Best-effort plain text of an uploaded document; '' if unsupported."""
+    if not file_data:
+        return ''
+    name = (filename or '').lower()
+    file_type = file_type or ''
+    if file_type == 'application/pdf' or name.endswith('.pdf'):
+        from pypdf import PdfReader
+        reader = PdfReader(io.BytesIO(file_data))
+        return '\n'.join(page.extract_text() or '' for page in reader.pages)
+    if name.endswith('.docx') or 'wordprocessingml' in file_type:
+        with zipfile.ZipFile(io.BytesIO(file_data)) as zf:
+            xml = zf.read('word/document.xml').decode('utf-8', errors='replace')
+        return re.sub(r'<[^>]+>', ' ', xml.replace('</w:p>', '\n'))
+    if file_type.startswith('text/') or name.endswith(('.txt', '.md', '.csv')):
+        return file_data.decode('utf-8', errors='replace')
+    return ''
+
+
+def chunk_words(text):
+    """Split text into overlapping word chunks as (word_start, chunk_text)."""
+    words = text.split()
+    chunks = []
+    i = 0
+    while i < len(words):
+        chunks.append((i, ' '.join(words[i:i + CHUNK_SIZE])))
+        i += CHUNK_SIZE - CHUNK_OVERLAP
+    return chunks
+
+
+def hashed_term_counts(text):
+    """Map text to {feature index: count} using a stable hash of each token."""
+    counts = Counter()
+    for token in _TOKEN_RE.findall(text.lower()):
+        if len(token) > 2:
+            counts[zlib.crc32(token.encode()) & (N_FEATURES - 1)] += 1
+    return counts
+
+
+def _log_tf(counts):
+    features = np.fromiter(counts.keys(), dtype=np.int32, count=len(counts))
+    weights = 1.0 + np.log(np.fromiter(counts.values(), dtype=np.float64, count=len(counts)))
+    order = np.argsort(features)
+    return features[order], weights[order]
+
+
+# ---------------------------------------------------------------------------
+# Per-user chunk matrix
+# ---------------------------------------------------------------------------
+
+class ChunkIndex:
+    """Append-only, memory-mapped CSR matrix of one user's document chunks."""
+
+    def __init__(self, path):
+        self.path = path
+
+    # -- storage helpers ---------------------------------------------------
+
+    def _file(self, generation, name):
+        return os.path.join(self.path, f'g{generation}.{_ARRAYS[name][0]}')
+
+    def _df_file(self, generation):
+        return os.path.join(self.path, f'g{generation}.df.i32')
+
+    def _texts_file(self, generation):
+        return os.path.join(self.path, f'g{generation}.texts')
+
+    def read_meta(self):
+        try:
+            with open(os.path.join(self.path, 'meta.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"generation": 0, "rows": 0, "nnz": 0, "text_bytes": 0,
+                    "documents": [], "deleted": []}
+
+    def _write_meta(self, meta):
+        tmp = os.path.join(self.path, 'meta.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, 'meta.json'))
+
+    def _load(self, meta, name):
+        """Memory-map the valid prefix of one array (empty if nothing written)."""
+        count = meta['rows'] if name in _ROW_ARRAYS else meta['nnz']
+        dtype = _ARRAYS[name][1]
+        if count == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self._file(meta['generation'], name), dtype=dtype, mode='r', shape=(count,))
+
+    def _load_df(self, meta):
+        try:
+            return np.fromfile(self._df_file(meta['generation']), dtype=np.int32)
+        except FileNotFoundError:
+            return np.zeros(N_FEATURES, dtype=np.int32)
+
+    def _write_df(self, generation, df):
+        tmp = self._df_file(generation) + '.tmp'
+        df.astype(np.int32).tofile(tmp)
+        os.replace(tmp, self._df_file(generation))
+
+    @contextmanager
+    def _write_lock(self):
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, 'lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield self.read_meta()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _append(self, path, array, valid_bytes):
+        # Drop any tail left behind by an append that died before meta.json was updated
+        mode = 'r+b' if os.path.exists(path) else 'w+b'
+        with open(path, mode) as f:
+            f.truncate(valid_bytes)
+            f.seek(valid_bytes)
+            f.write(array.tobytes() if isinstance(array, np.ndarray) else array)
+
+    # -- public API --------------------------------------------------------
+
+    def document_ids(self):
+        return set(self.read_meta()['documents'])
+
+    def add_document(self, doc_id, text):
+        """Append the chunks of one document. Returns the number of chunks added."""
+        chunks = chunk_words(text)
+        with self._write_lock() as meta:
+            if doc_id in meta['documents']:
+                return 0
+            if doc_id in meta['deleted']:
+                # The id is being reused (SQLite can recycle them); drop the old rows first
+                self._compact(meta)
+                meta = self.read_meta()
+            gen = meta['generation']
+            df = self._load_df(meta)
+
+            indptr, indices, data, word_starts, text_ends = [], [], [], [], []
+            nnz = meta['nnz']
+            text_bytes = meta['text_bytes']
+            encoded = []
+            for word_start, chunk_text in chunks:
+                features, weights = _log_tf(hashed_term_counts(chunk_text))
+                norm = np.linalg.norm(weights)
+                if norm:
+                    weights /= norm
+                indices.append(features)
+                data.append(weights.astype(np.float32))
+                df[features] += 1
+                nnz += len(features)
+                indptr.append(nnz)
+                word_starts.append(word_start)
+                raw = chunk_text.encode('utf-8')
+                encoded.append(raw)
+                text_bytes += len(raw)
+                text_ends.append(text_bytes)
+
+            if chunks:
+                rows = meta['rows']
+                itemsize = {name: np.dtype(dtype).itemsize for name, (_, dtype) in _ARRAYS.items()}
+                self._append(self._file(gen, 'indices'), np.concatenate(indices), meta['nnz'] * itemsize['indices'])
+                self._append(self._file(gen, 'data'), np.concatenate(data), meta['nnz'] * itemsize['data'])
+                self._append(self._texts_file(gen), b''.join(encoded), meta['text_bytes'])
+                self._append(self._file(gen, 'indptr'), np.array(indptr, dtype=np.int64), rows * itemsize['indptr'])
+                self._append(self._file(gen, 'doc_ids'), np.full(len(chunks), doc_id, dtype=np.int32), rows * itemsize['doc_ids'])
+                self._append(self._file(gen, 'word_start'), np.array(word_starts, dtype=np.int32), rows * itemsize['word_start'])
+                self._append(self._file(gen, 'text_end'), np.array(text_ends, dtype=np.int64), rows * itemsize['text_end'])
+                self._write_df(gen, df)
+
+            meta['documents'].append(doc_id)
+            meta.update(rows=meta['rows'] + len(chunks), nnz=nnz, text_bytes=text_bytes)
+            self._write_meta(meta)
+            return len(chunks)
+
+    def remove_document(self, doc_id):
+        """Tombstone a document's rows and take them out of the document frequencies."""
+        with self._write_lock() as meta:
+            if doc_id not in meta['documents']:
+                return False
+            df = self._load_df(meta)
+            indptr = self._load(meta, 'indptr')
+            starts = np.concatenate(([0], indptr[:-1]))
+            rows = np.flatnonzero(self._load(meta, 'doc_ids') == doc_id)
+            indices = self._load(meta, 'indices')
+            for row in rows:
+                np.subtract.at(df, indices[starts[row]:indptr[row]], 1)
+            self._write_df(meta['generation'], df)
+            meta['documents'].remove(doc_id)
+            meta['deleted'].append(doc_id)
+            self._write_meta(meta)
+            dead = int(np.isin(self._load(meta, 'doc_ids'), meta['deleted']).sum())
+            if meta['rows'] and dead / meta['rows'] >= COMPACT_RATIO:
+                self._compact(meta)
+            return True
+
+    def _compact(self, meta):
+        """Rewrite live rows into a fresh generation and drop the old files."""
+        old_gen = meta['generation']
+        new_gen = old_gen + 1
+        doc_ids = self._load(meta, 'doc_ids')
+        keep = ~np.isin(doc_ids, meta['deleted'])
+        indptr = self._load(meta, 'indptr')
+        starts = np.concatenate(([0], indptr[:-1]))
+        text_end = self._load(meta, 'text_end')
+        text_start = np.concatenate(([0], text_end[:-1]))
+        indices = self._load(meta, 'indices')
+        data = self._load(meta, 'data')
+        texts = np.memmap(self._texts_file(old_gen), dtype=np.uint8, mode='r') if meta['text_bytes'] else b''
+
+        rows = np.flatnonzero(keep)
+        lengths = (indptr - starts)[rows]
+        text_lengths = (text_end - text_start)[rows]
+        new = {
+            'indptr': np.cumsum(lengths, dtype=np.int64),
+            'indices': np.concatenate([indices[starts[r]:indptr[r]] for r in rows]) if len(rows) else np.zeros(0, np.int32),
+            'data': np.concatenate([data[starts[r]:indptr[r]] for r in rows]) if len(rows) else np.zeros(0, np.float32),
+            'doc_ids': np.asarray(doc_ids[rows], dtype=np.int32),
+            'word_start': np.asarray(self._load(meta, 'word_start')[rows], dtype=np.int32),
+            'text_end': np.cumsum(text_lengths, dtype=np.int64),
+        }
+        for name, array in new.items():
+            self._append(self._file(new_gen, name), array, 0)
+        self._append(self._texts_file(new_gen),
+                     b''.join(bytes(texts[text_start[r]:text_end[r]]) for r in rows), 0)
+        self._write_df(new_gen, self._load_df(meta))
+
+        new_meta = {
+            "generation": new_gen,
+            "rows": len(rows),
+            "nnz": int(new['indptr'][-1]) if len(rows) else 0,
+            "text_bytes": int(new['text_end'][-1]) if len(rows) else 0,
+            "documents": meta['documents'],
+            "deleted": [],
+        }
+        self._write_meta(new_meta)
+        for name in _ARRAYS:
+            _remove_quietly(self._file(old_gen, name))
+        _remove_quietly(self._texts_file(old_gen))
+        _remove_quietly(self._df_file(old_gen))
+
+    def search(self, query, k=10):
+        """Top-k chunks for ``query`` as dicts with document_id, score and text."""
+        try:
+            return self._search(self.read_meta(), query, k)
+        except FileNotFoundError:
+            # A compaction swapped generations under us; the new meta is in place now
+            return self._search(self.read_meta(), query, k)
+
+    def _search(self, meta, query, k):
+        if not meta['rows']:
+            return []
+        counts = hashed_term_counts(query)
+        if not counts:
+            return []
+        df = self._load_df(meta)
+        features, weights = _log_tf(counts)
+        idf = np.log((meta['rows'] + 1) / (df[features].astype(np.float64) + 1)) + 1
+        weights *= idf
+        q = np.zeros(N_FEATURES, dtype=np.float32)
+        q[features] = weights / np.linalg.norm(weights)
+
+        # Sparse matrix-vector product: per-row sums of data * q[indices] in a
+        # single float32 buffer of nnz values. reduceat only gets the starts of
+        # non-empty rows; empty rows have zero width, so each segment still
+        # ends at its own row's end, and their scores stay 0.
+        indptr = self._load(meta, 'indptr')
+        starts = np.empty_like(indptr)
+        starts[0] = 0
+        starts[1:] = indptr[:-1]
+        products = q[self._load(meta, 'indices')]
+        products *= self._load(meta, 'data')
+        scores = np.zeros(len(indptr), dtype=np.float32)
+        nonempty = indptr > starts
+        if nonempty.any():
+            scores[nonempty] = np.add.reduceat(products, starts[nonempty])
+
+        doc_ids = self._load(meta, 'doc_ids')
+        if meta['deleted']:
+            scores[np.isin(doc_ids, meta['deleted'])] = 0.0
+
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        top = top[scores[top] > 0]
+        if not len(top):
+            return []
+
+        text_end = self._load(meta, 'text_end')
+        word_start = self._load(meta, 'word_start')
+        texts = np.memmap(self._texts_file(meta['generation']), dtype=np.uint8, mode='r')
+        results = []
+        for row in top:
+            start = int(text_end[row - 1]) if row else 0
+            results.append({
+                "document_id": int(doc_ids[row]),
+                "word_start": int(word_start[row]),
+                "score": round(float(scores[row]), 6),
+                "text": bytes(texts[start:int(text_end[row])]).decode('utf-8', errors='replace'),
+            })
+        return results
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def index_for_user(user_id):
+    return ChunkIndex(os.path.join(SEARCH_INDEX_DIR, str(user_id)))
+
+
+def index_document(doc):
+    """Add a Document row to its owner's chunk matrix.
+
+    Unreadable files are recorded with no chunks so they are not retried on
+    every search.
+    """
+    try:
+        text = extract_text(doc.filename, doc.file_type, doc.file_data)
+    except Exception:
+        text = ''
+    return index_for_user(doc.user_id).add_document(doc.id, text)
+
+
+def remove_document(user_id, doc_id):
+    return index_for_user(user_id).remove_document(doc_id)
+
+
+def sync_user_index(user_id, documents):
+    """Bring a user's index in line with their documents, in the calling thread.
+
+    ``documents`` maps document id to a zero-argument loader returning the
+    Document, so file data is only fetched for documents not yet indexed.
+    Used by the index-documents CLI command; requests use queue_sync instead.
+    """
+    index = index_for_user(user_id)
+    indexed = index.document_ids()
+    for doc_id in indexed - set(documents):
+        index.remove_document(doc_id)
+    for doc_id in set(documents) - indexed:
+        doc = documents[doc_id]()
+        if doc is not None:
+            index_document(doc)
+    return index
+
+
+# ---------------------------------------------------------------------------
+# Background indexer
+# ---------------------------------------------------------------------------
+
+_queue = queue.Queue()
+_queued = set()
+_queued_lock = threading.Lock()
+
+
+def _enqueue(action, user_id, doc_id):
+    with _queued_lock:
+        if (action, user_id, doc_id) in _queued:
+            return
+        _queued.add((action, user_id, doc_id))
+    _queue.put((action, user_id, doc_id))
+
+
+def queue_add(user_id, doc_id):
+    _enqueue('add', user_id, doc_id)
+
+
+def queue_remove(user_id, doc_id):
+    _enqueue('remove', user_id, doc_id)
+
+
+def queue_sync(user_id, doc_ids):
+    """Queue whatever it takes to match the index to ``doc_ids``.
+
+    Only compares ids, so it is cheap enough for a request. It also picks up
+    documents uploaded before the index existed and queue entries lost in a
+    restart. Returns the number of documents waiting to be indexed.
+    """
+    indexed = index_for_user(user_id).document_ids()
+    doc_ids = set(doc_ids)
+    for doc_id in indexed - doc_ids:
+        queue_remove(user_id, doc_id)
+    missing = doc_ids - indexed
+    for doc_id in missing:
+        queue_add(user_id, doc_id)
+    return len(missing)
+
+
+def _indexer_loop(app):
+    from database import db, Document
+
+    while True:
+        action, user_id, doc_id = _queue.get()
+        with app.app_context():
+            try:
+                if action == 'remove':
+                    remove_document(user_id, doc_id)
+                else:
+                    doc = db.session.get(Document, doc_id)
+                    if doc is not None:
+                        index_document(doc)
+            except Exception:
+                app.logger.exception("Failed to %s document %s in search index", action, doc_id)
+            finally:
+                db.session.remove()
+                with _queued_lock:
+                    _queued.discard((action, user_id, doc_id))
+
+
+def ensure_indexer(app):
+    """Start this process's indexer thread if it is not running."""
+    start_process_thread('search-indexer', _indexer_loop, app)
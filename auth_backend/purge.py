@@ -0,0 +1,293 @@
+"""Background purge engine for chats and documents.
+
+Deletes run as ``PurgeJob`` rows processed by a background thread in each
+worker. A job walks its table in primary-key order up to the largest id that
+existed when it was queued, deleting one bounded batch per short transaction
+and pausing between batches so other writers are never blocked for long. The
+job's cursor is committed together with each batch, so a job interrupted by a
+restart resumes where it stopped once its lease expires.
+
+Retention policies are turned into jobs periodically by the same thread.
+"""
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from database import db, ChatSession, ChatMessage, Document, PurgeJob, RetentionPolicy
+import doc_search
+from background import start_process_thread
+
+TARGETS = ('chats', 'documents')
+ACTIVE_STATUSES = ('pending', 'running')
+
+PURGE_SESSION_BATCH = int(os.environ.get('PURGE_SESSION_BATCH', '200'))
+PURGE_MESSAGE_BATCH = int(os.environ.get('PURGE_MESSAGE_BATCH', '1000'))
+PURGE_DOCUMENT_BATCH = int(os.environ.get('PURGE_DOCUMENT_BATCH', '50'))
+PURGE_BATCH_PAUSE = float(os.environ.get('PURGE_BATCH_PAUSE', '0.2'))
+PURGE_POLL_INTERVAL = float(os.environ.get('PURGE_POLL_INTERVAL', '10'))
+PURGE_LEASE_SECONDS = 60
+RETENTION_INTERVAL = int(os.environ.get('RETENTION_INTERVAL', '3600'))
+
+_wake = threading.Event()
+
+
+# ---------------------------------------------------------------------------
+# Queueing
+# ---------------------------------------------------------------------------
+
+def enqueue_purge(target, user_id=None, older_than=None, policy_id=None):
+    """Queue a purge and return the committed PurgeJob."""
+    if target not in TARGETS:
+        raise ValueError("target must be 'chats' or 'documents'")
+    model = ChatSession if target == 'chats' else Document
+    job = PurgeJob(
+        target=target, user_id=user_id, older_than=older_than, policy_id=policy_id,
+        max_id=db.session.query(db.func.max(model.id)).scalar() or 0,
+    )
+    if target == 'chats' and user_id is None and older_than is None:
+        job.max_message_id = db.session.query(db.func.max(ChatMessage.id)).scalar() or 0
+    db.session.add(job)
+    db.session.commit()
+    _wake.set()
+    return job
+
+
+def apply_retention_policies(force=False):
+    """Queue a purge for each enabled policy that is due. Returns the new jobs.
+
+    Every worker process runs this, so a policy is claimed with a conditional
+    UPDATE of last_run_at first and only the process that wins queues its job.
+    """
+    now = datetime.utcnow()
+    due = now if force else now - timedelta(seconds=RETENTION_INTERVAL)
+    jobs = []
+    for policy in RetentionPolicy.query.filter_by(enabled=True).all():
+        active = PurgeJob.query.filter(
+            PurgeJob.policy_id == policy.id, PurgeJob.status.in_(ACTIVE_STATUSES)
+        ).first()
+        if active:
+            continue
+        claimed = RetentionPolicy.query.filter(
+            RetentionPolicy.id == policy.id,
+            db.or_(RetentionPolicy.last_run_at.is_(None), RetentionPolicy.last_run_at < due),
+        ).update({RetentionPolicy.last_run_at: now}, synchronize_session=False)
+        db.session.commit()
+        if not claimed:
+            continue
+        jobs.append(enqueue_purge(policy.target, user_id=policy.user_id,
+                                  older_than=now - timedelta(days=policy.max_age_days),
+                                  policy_id=policy.id))
+    return jobs
+
+
+def _progress(job):
+    if job.status == 'done':
+        return 1.0
+    sessions = min(job.cursor / job.max_id, 1.0) if job.max_id else 0.0
+    if not job.max_message_id:
+        return round(sessions, 4)
+    # Unfiltered chat purges spend most of their time on the message walk
+    return round((min(job.message_cursor / job.max_message_id, 1.0) + sessions) / 2, 4)
+
+
+def job_json(job):
+    return {
+        "id": job.id,
+        "target": job.target,
+        "user_id": job.user_id,
+        "older_than": job.older_than.isoformat() if job.older_than else None,
+        "policy_id": job.policy_id,
+        "status": job.status,
+        "progress": _progress(job),
+        "deleted_sessions": job.deleted_sessions,
+        "deleted_messages": job.deleted_messages,
+        "deleted_documents": job.deleted_documents,
+        "error": job.error,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "updated_at": job.updated_at.isoformat() if job.updated_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Execution
+# ---------------------------------------------------------------------------
+
+def claim_job():
+    """Take the oldest runnable job, including running jobs whose lease expired.
+
+    The claim is a conditional UPDATE, so only one worker wins each job.
+    """
+    now = datetime.utcnow()
+    lease_free = db.or_(PurgeJob.locked_until.is_(None), PurgeJob.locked_until < now)
+    candidates = [row.id for row in db.session.query(PurgeJob.id)
+                  .filter(PurgeJob.status.in_(ACTIVE_STATUSES), lease_free)
+                  .order_by(PurgeJob.id).limit(5)]
+    for job_id in candidates:
+        claimed = PurgeJob.query.filter(
+            PurgeJob.id == job_id, PurgeJob.status.in_(ACTIVE_STATUSES), lease_free
+        ).update({
+            PurgeJob.status: 'running',
+            PurgeJob.locked_until: now + timedelta(seconds=PURGE_LEASE_SECONDS),
+            PurgeJob.updated_at: now,
+        }, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return db.session.get(PurgeJob, job_id)
+    return None
+
+
+def _touch(job):
+    now = datetime.utcnow()
+    job.updated_at = now
+    job.locked_until = now + timedelta(seconds=PURGE_LEASE_SECONDS)
+
+
+def _pause():
+    if PURGE_BATCH_PAUSE:
+        time.sleep(PURGE_BATCH_PAUSE)
+
+
+def _messages_batch(job):
+    """Delete the next primary-key range of chat_message for an unfiltered purge.
+
+    Returns False once every message up to max_message_id has been visited.
+    """
+    if job.message_cursor >= job.max_message_id:
+        return False
+    message_ids = [row.id for row in db.session.query(ChatMessage.id)
+                   .filter(ChatMessage.id > job.message_cursor, ChatMessage.id <= job.max_message_id)
+                   .order_by(ChatMessage.id).limit(PURGE_MESSAGE_BATCH)]
+    if message_ids:
+        job.deleted_messages += ChatMessage.query.filter(
+            ChatMessage.id >= message_ids[0], ChatMessage.id <= message_ids[-1]
+        ).delete(synchronize_session=False)
+        job.message_cursor = message_ids[-1]
+    else:
+        job.message_cursor = job.max_message_id
+    _touch(job)
+    db.session.commit()
+    return True
+
+
+def _chats_batch(job):
+    """Delete the next batch of matching sessions. Returns False when none are left."""
+    if _messages_batch(job):
+        return True
+
+    query = db.session.query(ChatSession.id).filter(
+        ChatSession.id > job.cursor, ChatSession.id <= job.max_id)
+    if job.user_id is not None:
+        query = query.filter(ChatSession.user_id == job.user_id)
+    if job.older_than is not None:
+        query = query.filter(ChatSession.last_activity < job.older_than)
+    session_ids = [row.id for row in query.order_by(ChatSession.id).limit(PURGE_SESSION_BATCH)]
+    if not session_ids:
+        return False
+
+    # Messages go first, in their own bounded transactions; the cursor only
+    # moves past these sessions once they are gone, so a restart redoes the rest.
+    # After an unfiltered message walk only messages added since remain.
+    while True:
+        message_ids = [row.id for row in db.session.query(ChatMessage.id)
+                       .filter(ChatMessage.session_id.in_(session_ids))
+                       .limit(PURGE_MESSAGE_BATCH)]
+        if not message_ids:
+            break
+        job.deleted_messages += ChatMessage.query.filter(
+            ChatMessage.id.in_(message_ids)).delete(synchronize_session=False)
+        _touch(job)
+        db.session.commit()
+        _pause()
+
+    # A message added since the last batch would be orphaned (or fail the FK on
+    # Postgres), so sweep stragglers in the same transaction as the sessions
+    job.deleted_messages += ChatMessage.query.filter(
+        ChatMessage.session_id.in_(session_ids)).delete(synchronize_session=False)
+    job.deleted_sessions += ChatSession.query.filter(
+        ChatSession.id.in_(session_ids)).delete(synchronize_session=False)
+    job.cursor = session_ids[-1]
+    _touch(job)
+    db.session.commit()
+    return True
+
+
+def _documents_batch(job):
+    """Delete the next batch of matching documents. Returns False when none are left."""
+    query = db.session.query(Document.id, Document.user_id).filter(
+        Document.id > job.cursor, Document.id <= job.max_id)
+    if job.user_id is not None:
+        query = query.filter(Document.user_id == job.user_id)
+    if job.older_than is not None:
+        query = query.filter(Document.uploaded_at < job.older_than)
+    rows = query.order_by(Document.id).limit(PURGE_DOCUMENT_BATCH).all()
+    if not rows:
+        return False
+
+    job.deleted_documents += Document.query.filter(
+        Document.id.in_([row.id for row in rows])).delete(synchronize_session=False)
+    job.cursor = rows[-1].id
+    _touch(job)
+    db.session.commit()
+    for row in rows:
+        doc_search.remove_document(row.user_id, row.id)
+    return True
+
+
+def run_job(job):
+    """Process a claimed job batch by batch until it is finished."""
+    batch = _chats_batch if job.target == 'chats' else _documents_batch
+    try:
+        while batch(job):
+            _pause()
+    except Exception as e:
+        db.session.rollback()
+        job = db.session.get(PurgeJob, job.id)
+        job.status = 'failed'
+        job.error = str(e)[:2000]
+        job.locked_until = None
+        job.updated_at = datetime.utcnow()
+        db.session.commit()
+        raise
+    job.status = 'done'
+    job.cursor = job.max_id
+    job.message_cursor = job.max_message_id
+    job.locked_until = None
+    job.finished_at = job.updated_at = datetime.utcnow()
+    db.session.commit()
+    return job
+
+
+def run_pending_jobs():
+    """Run every runnable job in the calling thread. Returns the number run."""
+    count = 0
+    while True:
+        job = claim_job()
+        if job is None:
+            return count
+        run_job(job)
+        count += 1
+
+
+# ---------------------------------------------------------------------------
+# Background worker
+# ---------------------------------------------------------------------------
+
+def _worker_loop(app):
+    while True:
+        with app.app_context():
+            try:
+                apply_retention_policies()
+                run_pending_jobs()
+            except Exception:
+                app.logger.exception("Purge worker error")
+            finally:
+                db.session.remove()
+        _wake.wait(PURGE_POLL_INTERVAL)
+        _wake.clear()
+
+
+def ensure_worker(app):
+    """Start this process's purge thread if it is not running."""
+    start_process_thread('purge-worker', _worker_loop, app)
@@ -0,0 +1,141 @@
+"""Denormalized chat session summaries.
+
+``ChatSession`` carries message_count, last_message_at, last_message_preview
+and content_bytes so session lists never have to load messages. The fields are
+bumped in the same transaction as every message insert; ``repair_summaries``
+rebuilds them from ``chat_message`` and ``find_inconsistent_sessions`` reports
+drift.
+"""
+from database import db, ChatSession, ChatMessage
+
+PREVIEW_LENGTH = 200
+REPAIR_BATCH_SIZE = 500
+
+
+def make_preview(content):
+    content = ' '.join(content.split())
+    if len(content) <= PREVIEW_LENGTH:
+        return content
+    return content[:PREVIEW_LENGTH - 1] + '…'
+
+
+def apply_new_messages(session_id, messages):
+    """Fold newly added messages into the session summary.
+
+    Call after adding ``messages`` to the session and before committing, so the
+    summary update shares the insert's transaction. The counters are bumped
+    with a single UPDATE ... SET x = x + n, so concurrent inserts don't lose
+    increments. The last-message fields only move forward, so an older insert
+    committing after a newer one leaves them alone. Messages must have
+    ``created_at`` set.
+    """
+    if not messages:
+        return
+    newest = max(messages, key=lambda m: m.created_at)
+    is_newer = db.or_(ChatSession.last_message_at.is_(None),
+                      ChatSession.last_message_at <= newest.created_at)
+    ChatSession.query.filter_by(id=session_id).update({
+        ChatSession.message_count: ChatSession.message_count + len(messages),
+        ChatSession.content_bytes: ChatSession.content_bytes + sum(
+            len(m.content.encode('utf-8')) for m in messages),
+        ChatSession.last_message_at: db.case(
+            (is_newer, newest.created_at), else_=ChatSession.last_message_at),
+        ChatSession.last_message_preview: db.case(
+            (is_newer, make_preview(newest.content)), else_=ChatSession.last_message_preview),
+    }, synchronize_session=False)
+
+
+def _content_bytes_expr():
+    if db.engine.dialect.name == 'sqlite':
+        return db.func.length(db.cast(ChatMessage.content, db.LargeBinary))
+    return db.func.octet_length(ChatMessage.content)
+
+
+def _actual_summaries(session_ids):
+    """Compute the true summary of each session straight from chat_message."""
+    aggregates = db.session.query(
+        ChatMessage.session_id,
+        db.func.count(ChatMessage.id),
+        db.func.coalesce(db.func.sum(_content_bytes_expr()), 0),
+    ).filter(ChatMessage.session_id.in_(session_ids)).group_by(ChatMessage.session_id).all()
+
+    # The last message is the newest by (created_at, id), as apply_new_messages sees it
+    position = db.func.row_number().over(
+        partition_by=ChatMessage.session_id,
+        order_by=(ChatMessage.created_at.desc(), ChatMessage.id.desc()),
+    ).label('position')
+    ranked = (db.session.query(ChatMessage.id, position)
+              .filter(ChatMessage.session_id.in_(session_ids)).subquery())
+    last_messages = {
+        m.session_id: m for m in
+        ChatMessage.query.join(ranked, ChatMessage.id == ranked.c.id).filter(ranked.c.position == 1)
+    }
+
+    summaries = {sid: (0, 0, None, None) for sid in session_ids}
+    for session_id, count, content_bytes in aggregates:
+        last = last_messages[session_id]
+        summaries[session_id] = (count, int(content_bytes), last.created_at, make_preview(last.content))
+    return summaries
+
+
+SUMMARY_FIELDS = ('message_count', 'content_bytes', 'last_message_at', 'last_message_preview')
+
+
+def _stored_summary(session):
+    return (session.message_count, session.content_bytes,
+            session.last_message_at, session.last_message_preview)
+
+
+def _session_id_batches(batch_size):
+    last_id = 0
+    while True:
+        ids = [row.id for row in db.session.query(ChatSession.id)
+               .filter(ChatSession.id > last_id)
+               .order_by(ChatSession.id)
+               .limit(batch_size)]
+        if not ids:
+            return
+        yield ids
+        last_id = ids[-1]
+
+
+def repair_summaries(batch_size=REPAIR_BATCH_SIZE):
+    """Backfill or repair every session summary. Returns the number of sessions fixed."""
+    fixed = 0
+    for ids in _session_id_batches(batch_size):
+        actual = _actual_summaries(ids)
+        for session in ChatSession.query.filter(ChatSession.id.in_(ids)).all():
+            if _stored_summary(session) != actual[session.id]:
+                (session.message_count, session.content_bytes,
+                 session.last_message_at, session.last_message_preview) = actual[session.id]
+                fixed += 1
+        db.session.commit()
+    return fixed
+
+
+def _summary_json(summary):
+    fields = dict(zip(SUMMARY_FIELDS, summary))
+    if fields['last_message_at'] is not None:
+        fields['last_message_at'] = fields['last_message_at'].isoformat()
+    return fields
+
+
+def find_inconsistent_sessions(batch_size=REPAIR_BATCH_SIZE):
+    """Return a report of sessions whose stored summary disagrees with their messages.
+
+    Each entry lists every compared field under ``stored`` and ``actual`` and
+    names the ones that differ under ``fields``.
+    """
+    problems = []
+    for ids in _session_id_batches(batch_size):
+        actual = _actual_summaries(ids)
+        for session in ChatSession.query.filter(ChatSession.id.in_(ids)).all():
+            stored = _stored_summary(session)
+            if stored != actual[session.id]:
+                problems.append({
+                    "session_id": session.id,
+                    "fields": [name for name, a, b in zip(SUMMARY_FIELDS, stored, actual[session.id]) if a != b],
+                    "stored": _summary_json(stored),
+                    "actual": _summary_json(actual[session.id]),
+                })
+    return problems
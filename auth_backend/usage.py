@@ -0,0 +1,209 @@
+"""AI usage event log with incrementally maintained hourly/daily rollups.
+
+Events from the track-usage routes are buffered in-process and written in
+batches. Each flush appends the raw events and folds them into the
+``usage_rollup`` table, so dashboard queries only ever read rollups. A flusher
+thread in every worker drains the buffer every USAGE_FLUSH_INTERVAL seconds, so
+an idle worker does not hold events back, and prunes raw events past the
+retention window every USAGE_COMPACT_INTERVAL seconds.
+"""
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+
+from background import start_process_thread
+from database import db, UsageEvent, UsageRollup
+
+GLOBAL_USER_ID = 0
+GRANULARITIES = ('hour', 'day')
+
+USAGE_FLUSH_SIZE = int(os.environ.get('USAGE_FLUSH_SIZE', '50'))
+USAGE_FLUSH_INTERVAL = float(os.environ.get('USAGE_FLUSH_INTERVAL', '5'))
+USAGE_EVENT_RETENTION_DAYS = int(os.environ.get('USAGE_EVENT_RETENTION_DAYS', '30'))
+USAGE_COMPACT_BATCH_SIZE = 1000
+USAGE_COMPACT_INTERVAL = int(os.environ.get('USAGE_COMPACT_INTERVAL', '3600'))
+
+_buffer = []
+_buffer_lock = threading.Lock()
+_last_flush = time.monotonic()
+
+
+def bucket_start(ts, granularity):
+    """Truncate a timestamp to the start of its hour or day bucket."""
+    if granularity == 'hour':
+        return ts.replace(minute=0, second=0, microsecond=0)
+    if granularity == 'day':
+        return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+    raise ValueError(f"unknown granularity: {granularity}")
+
+
+def bucket_step(granularity):
+    return timedelta(hours=1) if granularity == 'hour' else timedelta(days=1)
+
+
+def record_usage_event(user_id, tokens, created_at=None):
+    """Queue a usage event; flushes once the batch is full or stale.
+
+    Must be called inside an app context.
+    """
+    global _last_flush
+    with _buffer_lock:
+        _buffer.append((user_id, int(tokens), created_at or datetime.utcnow()))
+        due = (len(_buffer) >= USAGE_FLUSH_SIZE or
+               time.monotonic() - _last_flush >= USAGE_FLUSH_INTERVAL)
+    if due:
+        try:
+            flush_usage_events()
+        except Exception:
+            # The batch has been re-queued; the next flush will retry it.
+            current_app.logger.exception("Failed to flush usage events")
+
+
+def flush_usage_events():
+    """Write buffered events and fold them into the rollups. Returns the event count."""
+    global _last_flush
+    with _buffer_lock:
+        batch = _buffer[:]
+        del _buffer[:]
+        _last_flush = time.monotonic()
+    if not batch:
+        return 0
+
+    # Another worker may insert the same rollup row concurrently; retry once
+    # so the loser of that race updates the row instead.
+    for attempt in range(2):
+        try:
+            _write_batch(batch)
+            db.session.commit()
+            return len(batch)
+        except IntegrityError:
+            db.session.rollback()
+            if attempt:
+                _requeue(batch)
+                raise
+        except Exception:
+            db.session.rollback()
+            _requeue(batch)
+            raise
+
+
+def _requeue(batch):
+    with _buffer_lock:
+        _buffer[:0] = batch
+
+
+def _write_batch(batch):
+    db.session.bulk_insert_mappings(UsageEvent, [
+        {"user_id": user_id, "tokens": tokens, "created_at": created_at}
+        for user_id, tokens, created_at in batch
+    ])
+
+    deltas = defaultdict(lambda: [0, 0])
+    for user_id, tokens, created_at in batch:
+        for granularity in GRANULARITIES:
+            start = bucket_start(created_at, granularity)
+            for uid in (user_id, GLOBAL_USER_ID):
+                delta = deltas[(granularity, start, uid)]
+                delta[0] += 1
+                delta[1] += tokens
+
+    for (granularity, start, uid), (calls, tokens) in deltas.items():
+        updated = UsageRollup.query.filter_by(
+            granularity=granularity, bucket_start=start, user_id=uid
+        ).update({
+            UsageRollup.calls: UsageRollup.calls + calls,
+            UsageRollup.tokens: UsageRollup.tokens + tokens,
+        }, synchronize_session=False)
+        if not updated:
+            db.session.add(UsageRollup(
+                granularity=granularity, bucket_start=start, user_id=uid,
+                calls=calls, tokens=tokens,
+            ))
+            db.session.flush()
+
+
+def compact_usage_events(retention_days=None, batch_size=USAGE_COMPACT_BATCH_SIZE):
+    """Delete raw events older than the retention window in short batches.
+
+    Rollups are left untouched, so historical dashboards keep working.
+    """
+    if retention_days is None:
+        retention_days = USAGE_EVENT_RETENTION_DAYS
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    deleted = 0
+    while True:
+        ids = [row.id for row in db.session.query(UsageEvent.id)
+               .filter(UsageEvent.created_at < cutoff)
+               .order_by(UsageEvent.id)
+               .limit(batch_size)]
+        if not ids:
+            break
+        deleted += UsageEvent.query.filter(UsageEvent.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+    return deleted
+
+
+def usage_timeseries(granularity, since, until, user_id=GLOBAL_USER_ID):
+    """Return one point per bucket in [since, until], zero-filling empty buckets."""
+    since = bucket_start(since, granularity)
+    until = bucket_start(until, granularity)
+    rows = UsageRollup.query.filter(
+        UsageRollup.granularity == granularity,
+        UsageRollup.user_id == user_id,
+        UsageRollup.bucket_start >= since,
+        UsageRollup.bucket_start <= until,
+    ).all()
+    by_bucket = {r.bucket_start: r for r in rows}
+    points = []
+    current = since
+    while current <= until:
+        r = by_bucket.get(current)
+        points.append({
+            "bucket_start": current.isoformat(),
+            "calls": r.calls if r else 0,
+            "tokens": r.tokens if r else 0,
+        })
+        current += bucket_step(granularity)
+    return points
+
+
+def top_users(granularity, since, until, metric='tokens', limit=10):
+    """Rank users by calls or tokens summed over the buckets in [since, until]."""
+    calls = db.func.sum(UsageRollup.calls).label('calls')
+    tokens = db.func.sum(UsageRollup.tokens).label('tokens')
+    rows = db.session.query(UsageRollup.user_id, calls, tokens).filter(
+        UsageRollup.granularity == granularity,
+        UsageRollup.user_id != GLOBAL_USER_ID,
+        UsageRollup.bucket_start >= bucket_start(since, granularity),
+        UsageRollup.bucket_start <= bucket_start(until, granularity),
+    ).group_by(UsageRollup.user_id).order_by(
+        (tokens if metric == 'tokens' else calls).desc()
+    ).limit(limit).all()
+    return [{"user_id": r.user_id, "calls": int(r.calls), "tokens": int(r.tokens)} for r in rows]
+
+
+def _flusher_loop(app):
+    last_compact = time.monotonic()
+    while True:
+        time.sleep(USAGE_FLUSH_INTERVAL)
+        with app.app_context():
+            try:
+                flush_usage_events()
+                if time.monotonic() - last_compact >= USAGE_COMPACT_INTERVAL:
+                    # Deleting by age is idempotent, so workers compacting at once is harmless
+                    last_compact = time.monotonic()
+                    compact_usage_events()
+            except Exception:
+                app.logger.exception("Failed to flush or compact usage events")
+            finally:
+                db.session.remove()
+
+
+def ensure_usage_flusher(app):
+    """Start this process's periodic flush/compact thread if it is not running."""
+    start_process_thread('usage-flusher', _flusher_loop, app)